@@ -4,14 +4,36 @@ import logging
 import sys
 import os
 import argparse
+import multiprocessing
 import datetime
-import shlex
-from collections import Counter
+import re
+import signal
+import heapq
+from collections import defaultdict
+from operator import itemgetter
 
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
+# An Apache log line is made up of space separated parts. The timestamp is
+# wrapped in square brackets, and the request in quotes, as both can contain
+# spaces. Apache escapes quotes and backslashes within the request with a
+# backslash, which ApacheLogLine undoes.
+#   <ip> <ruser> <luser> [<time>] "<request>" <status> <bytes>
+_APACHE_RE = re.compile(r'^(\S+) (\S+) (\S+) \[([^\]]+)\] "((?:[^"\\]|\\.)*)" (\S+) (\S+)')
+_REQUEST_ESCAPE_RE = re.compile(r'\\(["\\])')
+_NONASCII_RE = re.compile(r'[^\x00-\x7f]')
+
+# Read log files in large blocks, to cut down the number of read syscalls.
+_READ_BUFFER_SIZE = 1 << 20
+
+# How long to wait, in seconds, for a pool worker's results before checking
+# again.
+_POOL_POLL_TIMEOUT = 1
+
+_BYTES_SUFFIXES = ('B', 'KB', 'MB', 'GB', 'TB')
+
 
 class ReportException(Exception):
     """Execution exception"""
@@ -42,14 +64,14 @@ def main():
 
     try:
         if args.folder:
-            print get_full_report(
+            write_reports(iter_reports(
                     file_paths=sorted(os.path.join(args.folder, f)
-                                      for f in os.listdir(args.folder)))
+                                      for f in os.listdir(args.folder))))
         elif args.input:
-            with open(args.input) as f:
-                print get_full_report(f)
+            with open(args.input, 'r', _READ_BUFFER_SIZE) as f:
+                write_reports(iter_reports(f))
         else:
-            print get_full_report(sys.stdin)
+            write_reports(iter_reports(sys.stdin))
     except LogInputError as exc:
         logging.exception("Failed to parse HTTP log; failed to produce a report.")
         sys.stderr.write("Failed to parse HTTP log; failed to produce a report.")
@@ -66,53 +88,130 @@ def main():
     return 0
 
 
-def get_full_report(log_file=None, file_paths=None):
-    def get_files():
+def write_reports(reports, out=None):
+    """Write formatted reports to out (stdout by default) as they are
+    produced. The reports are separated by a blank line, and only the ends
+    of the whole output are stripped."""
+    if out is None:
+        out = sys.stdout
+    # Write each report straight away, but hold back its trailing
+    # whitespace until we know another report follows it.
+    tail = None
+    for report_str in reports:
+        if tail is None:
+            report_str = report_str.lstrip()
+        else:
+            out.write(tail)
+            report_str = '\n' + report_str
+        body = report_str.rstrip()
+        out.write(body)
+        tail = report_str[len(body):]
+    out.write('\n')
+
+
+def iter_reports(log_file=None, file_paths=None):
+    """Generate the formatted monthly reports for the given logs, one at a
+    time"""
+    def get_reports():
         if log_file:
-            yield log_file
-        if file_paths:
-            for p in file_paths:
-                with open(p) as f:
-                    yield f
-
-    report_str = ''
-    report = None
-    for f in get_files():
-        for log_line in f.readlines():
-            log.debug("Handling line " + log_line)
-            apache_log = ApacheLogLine(log_line)
-            if report is None:
-                report = Report(apache_log.month_year)
-            if apache_log.month_year != report.title:
-                log.info("Formatting report " + report.title)
-                report_str += '\n' + str(report)
-                report = Report(apache_log.month_year)
+            for report in generate_reports(log_file):
+                yield report
+        if file_paths and len(file_paths) == 1:
+            with open(file_paths[0], 'r', _READ_BUFFER_SIZE) as f:
+                for report in generate_reports(f):
+                    yield report
+        elif file_paths:
+            for report in merge_reports(iter_file_reports(file_paths)):
+                yield report
+
+    for report in get_reports():
+        log.info("Formatting report " + report.title)
+        yield str(report)
+
+
+def iter_file_reports(file_paths):
+    """Parse the files in parallel, generating the list of monthly reports
+    for each file, in order"""
+    pool = multiprocessing.Pool(
+            processes=min(len(file_paths), multiprocessing.cpu_count()),
+            initializer=_init_worker)
+    try:
+        results = pool.imap(get_file_reports, file_paths)
+        while True:
+            # Wait with a timeout; on Python 2, a wait without one can't be
+            # interrupted by Ctrl-C.
             try:
-                report.add_log(apache_log)
-            except ReportException as exc:
-                exc.log_line = log_line
-                raise
-            except Exception:
-                logging.exception("Exception handling line: " + log_line)
-                raise
+                yield results.next(_POOL_POLL_TIMEOUT)
+            except multiprocessing.TimeoutError:
+                continue
+            except StopIteration:
+                break
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _init_worker():
+    """Set up a pool worker process"""
+    # Leave Ctrl-C to the parent process, which stops the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def get_file_reports(path):
+    """Get the list of monthly reports for a single log file"""
+    with open(path, 'r', _READ_BUFFER_SIZE) as f:
+        return list(generate_reports(f))
+
+
+def merge_reports(file_reports):
+    """Generate the reports from each file's list of reports in turn. A
+    month's logs may be split over several files, so the reports either side
+    of a file boundary are combined when they're for the same month."""
+    held = None
+    for reports in file_reports:
+        if not reports:
+            continue
+        if held is not None:
+            if reports[0].title == held.title:
+                held.merge(reports[0])
+                reports[0] = held
+            else:
+                yield held
+        for report in reports[:-1]:
+            yield report
+        held = reports[-1]
+    if held is not None:
+        yield held
+
+
+def generate_reports(log_file):
+    """Generate the monthly reports for the log lines in log_file"""
+    report = None
+    for log_line in log_file:
+        log.debug("Handling line %s", log_line)
+        apache_log = ApacheLogLine(log_line)
+        month_year = apache_log.month_year
+        if report is None:
+            report = Report(month_year)
+        if month_year != report.title:
+            yield report
+            report = Report(month_year)
+        try:
+            report.add_log(apache_log)
+        except ReportException as exc:
+            exc.log_line = log_line
+            raise
+        except Exception:
+            logging.exception("Exception handling line: " + log_line)
+            raise
 
     if report is not None:
-        report_str += '\n' + str(report)
-    return report_str.strip()
+        yield report
 
 
 class Report():
     """Stores data for a report, and formats it"""
-    def __init__(self, title):
-        log.info("Start new report " + title)
-        self.title = title
-        self.lang_amounts = {}
-        self.non_ascii_names = []
-        self.total_request_count = 0
-        self.successful_request_count = 0
-
-    def __str__(self):
-        return """
+    FORMAT = """
 {title} Report
 Top 5 Languages:
 {lang}
@@ -121,36 +220,56 @@ Request Success:
   {succ}
 
 Non-ascii filenames:
-  {non-ascii}""".format(**{'title': self.title,
-                           'lang': self.format_lang_table(),
-                           'succ': self.format_success(),
-                           'non-ascii': "\n  ".join(self.non_ascii_names)})
+  {non_ascii}"""
+
+    def __init__(self, title):
+        log.info("Start new report " + title)
+        self.title = title
+        self.lang_amounts = defaultdict(int)
+        self.non_ascii_names = []
+        self.total_request_count = 0
+        self.successful_request_count = 0
+
+    def __str__(self):
+        return self.FORMAT.format(title=self.title,
+                                  lang=self.format_lang_table(),
+                                  succ=self.format_success(),
+                                  non_ascii="\n  ".join(self.non_ascii_names))
 
     def format_lang_table(self):
         return "  \n".join(
                 "{:>7}  {}".format(self.format_bytes(s), l)
-                for (l, s) in Counter(self.lang_amounts).most_common(5))
+                for (l, s) in heapq.nlargest(5, self.lang_amounts.iteritems(),
+                                             key=itemgetter(1)))
 
     @staticmethod
     def format_bytes(num_bytes):
         res = float(num_bytes)
-        suffix = ['TB', 'GB', 'MB', 'KB', 'B']
-        while res >= 1000:
-            suffix.pop()
+        i = 0
+        while res >= 1000 and i < len(_BYTES_SUFFIXES) - 1:
             res = res / 1024
+            i += 1
         if res >= 100:
             fmt = "{:.0f}{:>3}"
         else:
             fmt = "{:.1f}{:>3}"
-        return fmt.format(res, suffix.pop())
+        return fmt.format(res, _BYTES_SUFFIXES[i])
 
     def format_success(self):
         return "{:.1f}%  ({:d} of {:d})".format(
                 float(self.successful_request_count) * 100 / self.total_request_count,
                 self.successful_request_count, self.total_request_count)
 
+    def merge(self, other):
+        """Add the details from another report for the same month"""
+        for lang, amount in other.lang_amounts.iteritems():
+            self.lang_amounts[lang] += amount
+        self.non_ascii_names.extend(other.non_ascii_names)
+        self.total_request_count += other.total_request_count
+        self.successful_request_count += other.successful_request_count
+
     def add_log(self, apache_log):
-        non_ascii_file = self.get_non_ascii_file(apache_log.path)
+        lang, non_ascii_file = get_path_details(apache_log.path)
         self.total_request_count += 1
         if non_ascii_file:
             self.non_ascii_names.append(non_ascii_file)
@@ -158,74 +277,34 @@ Non-ascii filenames:
             return
         self.successful_request_count += 1
         try:
-            try:
-                self.lang_amounts[self.get_lang(apache_log.path)] += int(apache_log.bytes)
-            except KeyError:
-                self.lang_amounts[self.get_lang(apache_log.path)] = int(apache_log.bytes)
+            self.lang_amounts[lang] += int(apache_log.bytes)
         except ValueError as exc:
             raise LogInputError("Bytes count in HTTP log is not an integer.",
-                                log_line=self.log_line,
+                                log_line=apache_log.log_line,
                                 exc=exc)
 
-    @staticmethod
-    def get_non_ascii_file(path):
-        filename = path.split('/')[-1]
-        try:
-            filename.decode('ascii')
-        except UnicodeDecodeError:
-            return filename
 
-    @staticmethod
-    def get_lang(path):
-        # Path is expected to be of the following format.
-        #   /<language>/<filename>
-        # e.g. /English/some_audio_file.wav
-        path_parts = path.split('/')
-        if len(path_parts) != 3:
-            # The path isn't the expected format, so we don't know what the
-            # language is.
-            return ''
-        return path_parts[1]
-
-
-class ApacheLogLine():
-    NAME_MAP = {
-        'ip': 0,
-        'ruser': 1,
-        'luser': 2,
-        'time': 3,
-        'request': 4,
-        'status': 5,
-        'bytes': 6,
-        }
+class ApacheLogLine(object):
+    __slots__ = ('log_line', 'parts', '_month_year',
+                 'ip', 'ruser', 'luser', 'time', 'request', 'status', 'bytes')
 
     def __init__(self, log_line):
-        # The apache log is made up of parts, separated by spaces.
-        # Some parts can be multi-word, and so wrapped in quotes.
-        # The shlex.split handles that for us.
-        # There's one wrinkle; the timestamp has spaces, and isn't
-        # wrapped in quotes (it's wrapped in square brackets instead),
-        # so we'll normalise that, here.
         self.log_line = log_line
-        self.parts = shlex.split(log_line)
-        self.parts[3] += ' ' + self.parts[4]
-        del self.parts[4]
-        self.parts[3] = self.parts[3].strip('[]')
+        self._month_year = None
+        m = _APACHE_RE.match(log_line)
+        if m is None:
+            raise LogInputError("Log line is malformatted; does not have the "
+                                "expected parts",
+                                log_line=log_line)
+        self.parts = m.groups()
+        (self.ip, self.ruser, self.luser, self.time, self.request,
+         self.status, self.bytes) = self.parts
+        if '\\' in self.request:
+            self.request = _REQUEST_ESCAPE_RE.sub(r'\1', self.request)
 
     def __str__(self):
         return "AccessLogLine: " + " ".join(self.parts)
 
-    def __getattr__(self, name):
-        try:
-            return self.parts[self.NAME_MAP[name]]
-        except KeyError:
-            raise AttributeError("{} has no {}".format(self, name))
-        except IndexError as exc:
-            raise LogInputError("Log line is malformatted; does not have the "
-                                "expected number of parts",
-                                log_line=self.log_line,
-                                exc=exc)
-
     @property
     def path(self):
         try:
@@ -241,20 +320,90 @@ class ApacheLogLine():
 
     @property
     def datetime(self):
-        formats = ['%d/%m/%Y:%H:%M:%S',
-                   '%d/%b/%Y:%H:%M:%S',
-                  ]
-        for fmt in formats:
-            try:
-                return datetime.datetime.strptime(self.time.split()[0], fmt)
-            except ValueError as exc:
-                pass
-        raise LogInputError("Could not parse date " + self.time,
-                            log_line=self.log_line)
+        dt = _parse_dt(self.time.split()[0])
+        if dt is None:
+            raise LogInputError("Could not parse date " + self.time,
+                                log_line=self.log_line)
+        return dt
 
     @property
     def month_year(self):
-        return self.datetime.strftime('%B %Y')
+        if self._month_year is None:
+            # Only parse and format timestamps we haven't already seen. A
+            # timestamp is only cached once it has parsed, so every line's
+            # timestamp is checked.
+            time_token = self.time.split()[0]
+            self._month_year = _MONTH_YEAR_CACHE.get(time_token)
+            if self._month_year is None:
+                self._month_year = self.datetime.strftime('%B %Y')
+                if len(_MONTH_YEAR_CACHE) >= _MONTH_YEAR_CACHE_SIZE:
+                    _MONTH_YEAR_CACHE.clear()
+                _MONTH_YEAR_CACHE[time_token] = self._month_year
+        return self._month_year
+
+
+_DT_FORMATS = ['%d/%m/%Y:%H:%M:%S',
+               '%d/%b/%Y:%H:%M:%S',
+              ]
+
+# Log lines share timestamps heavily (many requests per second, and all in
+# order), so cache the month of each timestamp; strptime and strftime are
+# slow.
+_MONTH_YEAR_CACHE = {}
+_MONTH_YEAR_CACHE_SIZE = 4096
+
+
+def _parse_dt(time_token):
+    """Parse the date part of an Apache log timestamp; None if it can't be
+    parsed"""
+    for fmt in _DT_FORMATS:
+        try:
+            dt = datetime.datetime.strptime(time_token, fmt)
+        except ValueError:
+            continue
+        if fmt != _DT_FORMATS[0]:
+            # A server logs in just the one style, so try this format first
+            # from now on.
+            _DT_FORMATS.remove(fmt)
+            _DT_FORMATS.insert(0, fmt)
+        return dt
+    return None
+
+
+# The same files get requested over and over, so cache what we get from
+# each path.
+_PATH_CACHE = {}
+_PATH_CACHE_SIZE = 8192
+
+
+def get_path_details(path):
+    """Get the (language, non-ascii filename) for a request path"""
+    details = _PATH_CACHE.get(path)
+    if details is not None:
+        return details
+    details = (get_lang(path), get_non_ascii_file(path))
+    if len(_PATH_CACHE) >= _PATH_CACHE_SIZE:
+        _PATH_CACHE.clear()
+    _PATH_CACHE[path] = details
+    return details
+
+
+def get_non_ascii_file(path):
+    filename = path.rpartition('/')[2]
+    if _NONASCII_RE.search(filename):
+        return filename
+
+
+def get_lang(path):
+    # Path is expected to be of the following format.
+    #   /<language>/<filename>
+    # e.g. /English/some_audio_file.wav
+    path_parts = path.split('/', 2)
+    if len(path_parts) != 3 or '/' in path_parts[2]:
+        # The path isn't the expected format, so we don't know what the
+        # language is.
+        return ''
+    return path_parts[1]
 
 
 if __name__ == '__main__':